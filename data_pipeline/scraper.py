@@ -1,6 +1,5 @@
-import pandas as pd
-import numpy as np
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
 import requests
 from supabase import create_client
 import time
@@ -9,6 +8,9 @@ import os
 from dotenv import load_dotenv
 from datetime import datetime
 import re
+from html import unescape
+import email.utils
+from dataclasses import dataclass
 import subprocess
 import sys
 from requests.adapters import HTTPAdapter
@@ -17,11 +19,19 @@ import random
 import cProfile
 import pstats
 import io
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import threading
+import itertools
 from time import monotonic
 import faulthandler
 import json
+import orjson
+
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:  # optional dependency; falls back to a plain set
+    ScalableBloomFilter = None
 
 # -------------------------
 # CONFIGURATION / TOGGLES
@@ -32,14 +42,37 @@ PAGE_LIMIT = 20
 DB_REFRESH_RATE = 10
 BATCH_SIZE = 200
 BATCH_SIZE_POSTCODES = 50
-POSTCODE_PATTERN = r'^\d{4}[A-Z]{2}$'
 BASE_URL_POST_CODE_API = "https://openpostcode.nl/api/address"
 POST_CODE_BATCH_SIZE = 100
 MAX_DUPLICATES_REMOVAL = 1000
 
+# Default scrape buckets, used when ranges.json is missing. Plain tuples —
+# they are only ever indexed scalar-wise, so numpy buys nothing here.
+DEFAULT_PRICE_RANGES = (
+    0, 500, 650, 700, 750, 850, 1000, 1100, 1250, 1500, 1750, 2000, 2250, 2500, 2750, 3000, 3250, 3500, 4000, 4500,
+    5000, 5500, 6000, 6500, 7000, 7500, 8000, 8500, 9000, 9500, 10000, 10500, 11000, 11500, 12000, 12500, 13000,
+    13500, 14000, 14500, 15000, 15500, 16000, 16500, 17000, 17500, 18000, 18500, 19000, 19500, 19750, 20000, 20500,
+    21000, 21500, 22000, 22500, 23000, 23500, 24000, 24500, 25000, 26000, 27000, 28000, 28500, 29000, 30000, 31000, 32000,
+    33000, 34000, 34500, 35000, 35500, 36000, 36500, 37000, 37500, 38000, 39000, 39500, 40000, 41000, 42000, 43000, 43500, 44000, 44500, 45000,
+    46000, 47000, 48000, 49000, 50000, 51000, 52000, 53000, 54000, 55000, 56000, 57000, 58000, 59000, 60000, 61000,
+    62000, 64000, 66000, 68000, 70000, 75000, 80000, 85000, 90000, 95000, 100000, 125000, 150000, int(1e9))
+
+DEFAULT_KM_RANGES = (
+    0, 1, 2, 5, 7, 8, 10, 11, 12, 15, 20, 50, 100, 200, 500, 1000, 2000, 3000, 5000, 10000, 15000, 20000, 25000,
+    30000, 35000, 40000, 45000, 50000, 55000, 60000, 70000, 80000, 85000, 90000, 95000, 100000, 110000, 120000, 130000, 140000,
+    145000, 150000, 155000, 160000, 170000, 180000, 190000, 200000, 210000, 220000, 230000, 240000, 260000, 280000,
+    300000, 350000, 400000, int(1e9))
+
 ENABLE_MULTITHREADING = True
 MAX_WORKERS = 8
 
+# Hold known car IDs in a Bloom filter (~1 byte/ID instead of a ~80 byte str
+# per entry). False positives only skip the odd listing, which the upsert with
+# ignore_duplicates and remove_duplicates() already tolerate.
+USE_BLOOM_FILTER = True
+BLOOM_INITIAL_CAPACITY = 1_000_000
+BLOOM_ERROR_RATE = 0.001
+
 ENABLE_RATE_LIMITING = True
 RATE_LIMIT_LOGGING = 500
 REQUESTS_PER_SECOND = 5
@@ -51,36 +84,76 @@ THROTTLE_CHECK_INTERVAL = 20        # requests before checking 429 ratio
 THROTTLE_429_THRESHOLD = 0.1        # 10% of requests = slowdown trigger
 THROTTLE_REDUCTION_FACTOR = 0.8     # reduce RPS by 20%
 THROTTLE_MIN_RPS = 1.0              # min 1 request/sec
+THROTTLE_MAX_RPS = 10.0             # AIMD ceiling when recovering
+THROTTLE_ADDITIVE_STEP = 0.25       # RPS added after a clean window
 THROTTLE_DELAY_INCREASE = 1.5       # increase delay range by 50%
 MAX_TOTAL_429 = 50                 # stop script after this many 429s total
+MAX_RETRY_AFTER = 60               # cap (seconds) when honoring Retry-After headers
+
+_INITIAL_DELAY_RANGE = RANDOM_DELAY_RANGE
 
 # -------------------------
 # NETWORK HELPERS
 # -------------------------
-_last_request_time = monotonic()
+# Next allowed send time; advanced atomically under _rate_limit_lock so the
+# lock is never held across a sleep.
+_next_slot = monotonic()
 _rate_limit_lock = threading.Lock()
 
-_request_count = 0
+# itertools.count.__next__ is implemented in C and atomic under the GIL,
+# so requests can be counted without taking a lock per call.
+_request_counter = itertools.count(1)
 _start_window = monotonic()
 
 _throttle_lock = threading.Lock()
-_429_count = 0
+_attempt_counter = itertools.count(1)
+_429_counter = itertools.count(1)
+# Mirrors of the counters (plain assignments, atomic under the GIL) plus the
+# window baselines used by the adaptive throttle check.
 _total_request_attempts = 0
 _total_429_global = 0
+_window_start_attempts = 0
+_window_start_429 = 0
+
+# Shared Supabase client (lazy init, see get_supabase_client)
+_supabase_client = None
+_supabase_lock = threading.Lock()
+
+# Ask for compressed bodies explicitly (search-result HTML gzips >5:1) and
+# reinforce connection reuse; requests decompresses transparently.
+_DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept-Language": "nl-NL",
+    "Connection": "keep-alive",
+}
 
 # Global shared session with retry + backoff
 _session = requests.Session()
+_session.headers.update(_DEFAULT_HEADERS)
 
 # Define retry strategy
 _retry_strategy = Retry(
     total=5,                # Retry up to 5 times
     backoff_factor=1,       # Wait 1s, then 2s, 4s, etc.
     status_forcelist=[429, 500, 502, 503, 504],  # Retry on these status codes
-    allowed_methods=["GET", "POST"]              # Safe methods to retry
+    allowed_methods=["GET", "POST"],             # Safe methods to retry
+    respect_retry_after_header=True              # Prefer the server's own back-off hint
 )
 
-# Attach the adapter to both HTTP and HTTPS
-_adapter = HTTPAdapter(max_retries=_retry_strategy, pool_connections=100, pool_maxsize=100)
+# Attach the adapter to both HTTP and HTTPS. The pool is sized to the worker
+# count and blocks when full, so threads wait for a keep-alive connection
+# instead of opening throwaway sockets beyond the pool.
+_adapter = HTTPAdapter(max_retries=_retry_strategy, pool_connections=2,
+                       pool_maxsize=MAX_WORKERS, pool_block=True)
+# openpostcode.nl answers 500 for unknown postcodes and 429 under load, and
+# fetch_one_postcode handles both status codes itself — urllib3 retries with
+# raise_on_status would turn them into RetryError before that code runs (and
+# spend ~31s backing off per unknown postcode), so this host gets a
+# non-retrying adapter mounted on top of the catch-all one.
+_postcode_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=MAX_WORKERS,
+                                pool_block=True)
 _session.mount("http://", _adapter)
 _session.mount("https://", _adapter)
 faulthandler.enable()
@@ -92,8 +165,11 @@ def get_thread_session():
     s = getattr(_thread_local, "session", None)
     if s is None:
         s = requests.Session()
+        s.headers.update(_DEFAULT_HEADERS)
         s.mount("http://", _adapter)
         s.mount("https://", _adapter)
+        # Longest-prefix match: postcode lookups bypass the retrying adapter
+        s.mount(BASE_URL_POST_CODE_API, _postcode_adapter)
         _thread_local.session = s
     return s
 
@@ -115,25 +191,45 @@ sys.excepthook = _sys_excepthook
 # -------------------------
 # UTILITY FUNCTIONS
 # -------------------------
+def _parse_retry_after(header_value):
+    """Parse a Retry-After header (seconds or HTTP-date) into a capped delay, or None."""
+    if not header_value:
+        return None
+    try:
+        delay = float(header_value)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(header_value)
+            delay = (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    if delay <= 0:
+        return None
+    return min(delay, MAX_RETRY_AFTER)
+
+
 def fetch_page(url, params, timeout=30, session=None):
     """Fetch a URL with retries and return response.text or None on failure."""
 
-    global _429_count, _total_request_attempts, _total_429_global
+    global _total_request_attempts, _total_429_global
 
     # Use a per-thread session unless one was explicitly provided
     session = session or get_thread_session()
 
     try:
         response = session.get(url, params=params, timeout=timeout)
-        _total_request_attempts += 1
+        _total_request_attempts = next(_attempt_counter)
         if response.status_code == 429:
-            _429_count += 1
-            _total_429_global += 1
+            _total_429_global = next(_429_counter)
             logging.warning(f"HTTP 429 Too Many Requests for URL: {url}")
             # Stop script if threshold reached
             if _total_429_global >= MAX_TOTAL_429:
                 logging.critical(f"Exceeded MAX_TOTAL_429 ({MAX_TOTAL_429}). Stopping script immediately.")
                 sys.exit("Too many 429 errors — stopping script.")
+            delay = _parse_retry_after(response.headers.get("Retry-After"))
+            if delay:
+                logging.info(f"Honoring Retry-After header: sleeping {delay:.0f}s")
+                time.sleep(delay)
         response.raise_for_status()
         return response.text
     except requests.exceptions.ReadTimeout:
@@ -145,13 +241,19 @@ def fetch_page(url, params, timeout=30, session=None):
 
 def adjust_rate_limit_if_needed():
     """Automatically reduce request rate and increase delay when too many 429s occur."""
-    global _429_count, _total_request_attempts, REQUESTS_PER_SECOND, RANDOM_DELAY_RANGE
+    global _window_start_attempts, _window_start_429, REQUESTS_PER_SECOND, RANDOM_DELAY_RANGE
+
+    # Cheap lock-free pre-check; only cross the lock when a window completes
+    if not ADAPTIVE_THROTTLE_ENABLED or _total_request_attempts - _window_start_attempts < THROTTLE_CHECK_INTERVAL:
+        return
 
     with _throttle_lock:
-        if not ADAPTIVE_THROTTLE_ENABLED or _total_request_attempts < THROTTLE_CHECK_INTERVAL:
+        window_attempts = _total_request_attempts - _window_start_attempts
+        if window_attempts < THROTTLE_CHECK_INTERVAL:
             return
 
-        ratio_429 = _429_count / _total_request_attempts
+        window_429 = _total_429_global - _window_start_429
+        ratio_429 = window_429 / window_attempts
         if ratio_429 >= THROTTLE_429_THRESHOLD:
             old_rps = REQUESTS_PER_SECOND
             REQUESTS_PER_SECOND = max(THROTTLE_MIN_RPS, REQUESTS_PER_SECOND * THROTTLE_REDUCTION_FACTOR)
@@ -165,47 +267,75 @@ def adjust_rate_limit_if_needed():
                 f"Reducing RPS from {old_rps:.2f} to {REQUESTS_PER_SECOND:.2f}, "
                 f"increasing delay to {RANDOM_DELAY_RANGE}."
             )
-        _429_count = 0
-        _total_request_attempts = 0
+        elif window_429 == 0 and REQUESTS_PER_SECOND < THROTTLE_MAX_RPS:
+            # AIMD recovery: a clean window earns a small additive bump so a
+            # transient 429 spike doesn't cap throughput for the whole run.
+            old_rps = REQUESTS_PER_SECOND
+            REQUESTS_PER_SECOND = min(THROTTLE_MAX_RPS, REQUESTS_PER_SECOND + THROTTLE_ADDITIVE_STEP)
+            RANDOM_DELAY_RANGE = (
+                max(_INITIAL_DELAY_RANGE[0], RANDOM_DELAY_RANGE[0] / THROTTLE_DELAY_INCREASE),
+                max(_INITIAL_DELAY_RANGE[1], RANDOM_DELAY_RANGE[1] / THROTTLE_DELAY_INCREASE)
+            )
+            logging.info(
+                f"Clean window, increasing RPS from {old_rps:.2f} to {REQUESTS_PER_SECOND:.2f}, "
+                f"delay back to {RANDOM_DELAY_RANGE}."
+            )
+        _window_start_attempts = _total_request_attempts
+        _window_start_429 = _total_429_global
 
 
-def rate_limited_fetch_page(url, params, max_retries=3, timeout=30):
-    """Wrapper for fetch_page that enforces a global rate limit and random delay."""
-    global _last_request_time, _request_count, _start_window
+def _acquire_send_slot():
+    """Claim the next global send slot and sleep until it arrives.
 
-    # --- Add jitter ---
-    if RANDOM_DELAY_RANGE:
-        time.sleep(random.uniform(*RANDOM_DELAY_RANGE))
+    Shared by every outbound fetch (scrape pages and postcode lookups alike)
+    so the aggregate request rate stays capped at REQUESTS_PER_SECOND no
+    matter how many workers are sending.
+    """
+    global _next_slot
 
     if ENABLE_RATE_LIMITING:
+        min_interval = 1.0 / REQUESTS_PER_SECOND
+        # Claim the next send slot while holding the lock only for the
+        # read-modify-write; the actual wait happens outside it.
         with _rate_limit_lock:
-            now = monotonic()
-            min_interval = 1.0 / REQUESTS_PER_SECOND
-            elapsed = now - _last_request_time
-            if elapsed < min_interval:
-                time.sleep(min_interval - elapsed)
-            _last_request_time = monotonic()
+            slot = max(monotonic(), _next_slot)
+            _next_slot = slot + min_interval
+        wait = slot - monotonic()
+        if wait > 0:
+            # The limiter already spaces this request out; no extra jitter
+            time.sleep(wait)
+        elif RANDOM_DELAY_RANGE:
+            # Would fire immediately after the previous request: add jitter
+            time.sleep(random.uniform(*RANDOM_DELAY_RANGE))
+    elif RANDOM_DELAY_RANGE:
+        time.sleep(random.uniform(*RANDOM_DELAY_RANGE))
+
+
+def rate_limited_fetch_page(url, params, max_retries=3, timeout=30):
+    """Wrapper for fetch_page that enforces a global rate limit and random delay."""
+    global _start_window
+
+    _acquire_send_slot()
 
     # --- Fetch the page ---
     result = fetch_page(url, params, timeout=timeout)
     adjust_rate_limit_if_needed()
 
-    # --- Log actual requests/sec every 10 requests ---
-    with _rate_limit_lock:
-        _request_count += 1
-        if _request_count % RATE_LIMIT_LOGGING == 0:
+    # --- Log actual requests/sec every RATE_LIMIT_LOGGING requests ---
+    if next(_request_counter) % RATE_LIMIT_LOGGING == 0:
+        with _rate_limit_lock:
             now = monotonic()
             elapsed_window = now - _start_window
-            rps = _request_count / elapsed_window if elapsed_window > 0 else 0
-            logging.info(f"Effective request rate: {rps:.2f} req/sec over last {elapsed_window:.1f}s")
-            _request_count = 0
             _start_window = now
+        rps = RATE_LIMIT_LOGGING / elapsed_window if elapsed_window > 0 else 0
+        logging.info(f"Effective request rate: {rps:.2f} req/sec over last {elapsed_window:.1f}s")
 
     return result
 
 
 def setup_logging():
     """Configure logging with a timestamped file."""
+    load_dotenv()
     current_dir = os.path.dirname(os.path.abspath(__file__))
     log_dir = os.path.join(current_dir, "logs")
     os.makedirs(log_dir, exist_ok=True)
@@ -236,46 +366,105 @@ def connect_vpn():
         logging.info("No VPN activated intentionally.")
 
 
-def is_valid_format(s, pattern):
-    """Check if string matches given regex pattern."""
-    return bool(re.fullmatch(pattern, s))
+def get_supabase_client():
+    """Return the shared Supabase client, creating it once on first use."""
+    global _supabase_client
+    if _supabase_client is None:
+        with _supabase_lock:
+            if _supabase_client is None:
+                supabase_url = os.getenv("SUPABASE_URL")
+                supabase_key = os.getenv("SUPABASE_KEY")
+                _supabase_client = create_client(supabase_url, supabase_key)
+    return _supabase_client
 
 
-def get_supabase_client():
-    """Create and return Supabase client from .env."""
-    load_dotenv()
-    supabase_url = os.getenv("SUPABASE_URL")
-    supabase_key = os.getenv("SUPABASE_KEY")
-    return create_client(supabase_url, supabase_key)
+def build_known_ids(car_ids):
+    """Build the membership structure for the known-car-ID hot check.
+
+    Returns a Bloom filter when enabled and available, otherwise a set.
+    """
+    if USE_BLOOM_FILTER and ScalableBloomFilter is not None:
+        known = ScalableBloomFilter(initial_capacity=BLOOM_INITIAL_CAPACITY,
+                                    error_rate=BLOOM_ERROR_RATE)
+        for car_id in car_ids:
+            known.add(car_id)
+        return known
+    return set(car_ids)
+
+
+def snapshot_known_ids(car_ids_in_database, car_ids_in_upsert):
+    """Immutable-ish view of the known IDs handed to scrape workers."""
+    if isinstance(car_ids_in_database, (set, frozenset)):
+        return frozenset(car_ids_in_database | car_ids_in_upsert)
+    # Bloom filter: shared directly; pending upsert IDs were already added on merge
+    return car_ids_in_database
+
+
+def iter_new_car_ids(table_name, start_after, pk_watermark):
+    """Yield car_ids for rows whose integer PK is above start_after.
+
+    Records the highest PK seen in pk_watermark[0] so the caller can keep a
+    watermark for the next incremental refresh (only rows added since are
+    fetched, instead of re-downloading the whole table).
+    """
+    for row in iter_all_rows_in_batches(table_name, "id", "car_id",
+                                        batch_size=50000, start_after=start_after):
+        pk_watermark[0] = row["id"]
+        yield row["car_id"]
 
 
 def fetch_existing_car_ids(table_name):
     """Fetch existing car IDs from Supabase."""
-    supabase = get_supabase_client()
     logging.info("Fetching existing car IDs from database...")
-    response = supabase.table(table_name).select("car_id").execute()
-    car_ids = {d['car_id'] for d in response.data}
+    car_ids = set(iter_all_rows_in_batches(table_name, "id", "car_id",
+                                           batch_size=10000, scalar_column="car_id"))
     logging.info(f"Found {len(car_ids)} existing car IDs.")
     return car_ids
 
 
+def pg_upsert(table_name, rows, on_conflict, ignore_duplicates=False):
+    """Bulk upsert rows straight to PostgREST over the shared pooled session.
+
+    Bypasses the Supabase client's separate httpx pool so DB writes reuse the
+    same keep-alive connections and Retry policy as the scrape traffic.
+    """
+    resolution = "ignore-duplicates" if ignore_duplicates else "merge-duplicates"
+    response = _session.post(
+        f"{os.getenv('SUPABASE_URL')}/rest/v1/{table_name}",
+        params={"on_conflict": on_conflict},
+        headers={
+            "apikey": os.getenv("SUPABASE_KEY"),
+            "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
+            "Prefer": f"resolution={resolution},return=minimal",
+            "Content-Type": "application/json",
+        },
+        data=orjson.dumps(rows),
+        timeout=30,
+    )
+    response.raise_for_status()
+
+
 def insert_batch_to_db(table_name, cars_to_insert):
     """Insert a batch of cars into Supabase."""
-    supabase = get_supabase_client()
     if cars_to_insert:
         logging.info(f"Inserting {len(cars_to_insert)} cars into database...")
-        supabase.table(table_name).upsert(cars_to_insert, ignore_duplicates=True).execute()
+        pg_upsert(table_name, cars_to_insert, on_conflict="car_id", ignore_duplicates=True)
 
 
-def fetch_all_rows_in_batches(
+def iter_all_rows_in_batches(
     table_name: str,
     key_column: str,
     columns: str = "*",
     batch_size: int = 5000,
-    max_batches: int | None = None
+    max_batches: int | None = None,
+    scalar_column: str | None = None,
+    start_after=None
 ):
     """
-    Fetch all rows from a Supabase table in batches to avoid timeouts.
+    Stream all rows from a Supabase table in batches to avoid timeouts.
+
+    Yields row dicts one by one (or bare column values when scalar_column is
+    set) so the caller never has to hold more than one batch in memory.
 
     Args:
         table_name: Name of the table to query
@@ -283,15 +472,19 @@ def fetch_all_rows_in_batches(
         columns: Comma-separated column names or "*" for all
         batch_size: Number of rows per batch
         max_batches: Optional limit (for testing or large tables)
-
-    Returns:
-        List of dicts containing all rows fetched.
+        scalar_column: If set, yield this column's values instead of a dict
+            per row (avoids per-row dict overhead)
+        start_after: If set, only yield rows whose key_column is greater than
+            this value (incremental/delta fetches)
     """
     supabase = get_supabase_client()
-    all_rows = []
+    # The pagination key must be part of the response for keyset tracking
+    if columns != "*" and key_column not in [c.strip() for c in columns.split(",")]:
+        columns = f"{columns}, {key_column}"
+    total_rows = 0
     offset = 0
     batch_count = 0
-    last_key = None
+    last_key = start_after
 
     while True:
         try:
@@ -303,156 +496,182 @@ def fetch_all_rows_in_batches(
             response = query.execute()
             data = response.data
 
-            if not data:
-                break
+        except Exception as e:
+            logging.error(f"Error fetching batch starting at {offset}: {e}")
+            time.sleep(2)
+            break
 
-            all_rows.extend(data)
-            last_key = data[-1][key_column]  # last key fetched
+        if not data:
+            break
 
-            offset += batch_size
-            batch_count += 1
-            logging.info(f"Fetched {len(data)} rows (total {len(all_rows)}).")
+        if scalar_column is not None:
+            yield from (row[scalar_column] for row in data)
+        else:
+            yield from data
+        last_key = data[-1][key_column]  # last key fetched
 
-            # Optional: stop early if max_batches is set
-            if max_batches and batch_count >= max_batches:
-                logging.info(f"Reached max_batches ({max_batches}), stopping early.")
-                break
+        total_rows += len(data)
+        offset += batch_size
+        batch_count += 1
+        logging.info(f"Fetched {len(data)} rows (total {total_rows}).")
 
-        except Exception as e:
-            logging.error(f"Error fetching batch starting at {offset}: {e}")
-            time.sleep(2)
+        # Optional: stop early if max_batches is set
+        if max_batches and batch_count >= max_batches:
+            logging.info(f"Reached max_batches ({max_batches}), stopping early.")
             break
 
-    return all_rows
+
+def fetch_all_rows_in_batches(*args, **kwargs):
+    """Materializing wrapper around iter_all_rows_in_batches for callers that need a list."""
+    return list(iter_all_rows_in_batches(*args, **kwargs))
 
 
 def remove_duplicates(table_name, chunk_size=1000, max_removals=MAX_DUPLICATES_REMOVAL):
     """Remove duplicate car_id entries from database."""
     logging.info(f"Removing duplicates from database.")
-    response = fetch_all_rows_in_batches(table_name, "car_id", "id, car_id, make, listing_price", batch_size=1000)
-    df_full = pd.DataFrame(response)
-    car_id_to_remove = df_full.loc[df_full.duplicated(subset=['car_id'], keep="first"), 'car_id'].values
-    logging.info(f"New method has: {len(car_id_to_remove)} duplicate entries in database.")
 
-    if len(car_id_to_remove) == 0:
+    # Prefer the server-side dedupe: the delete_duplicate_car_ids SQL function
+    # runs DELETE ... USING on car_id inside Postgres and returns the number of
+    # rows removed, so nothing has to cross the network.
+    try:
+        response = get_supabase_client().rpc("delete_duplicate_car_ids").execute()
+        logging.info(f"Server-side dedupe removed {response.data} duplicate rows.")
+        return
+    except Exception as e:
+        logging.warning(f"delete_duplicate_car_ids RPC unavailable ({e}); "
+                        f"falling back to client-side dedupe.")
+
+    # Rows stream in id order, so the first row seen per car_id is the oldest;
+    # only the later copies' ids are collected and deleted, keeping one row
+    seen = set()
+    ids_to_remove = []
+    for row in iter_all_rows_in_batches(table_name, "id", "car_id", batch_size=1000):
+        if row["car_id"] in seen:
+            ids_to_remove.append(row["id"])
+        else:
+            seen.add(row["car_id"])
+    logging.info(f"New method has: {len(ids_to_remove)} duplicate entries in database.")
+
+    if len(ids_to_remove) == 0:
         logging.info('No duplicates found in database.')
         return
 
     supabase = get_supabase_client()
-    logging.info(f"Removing {len(car_id_to_remove)} duplicate entries in database.")
-    if len(car_id_to_remove) > max_removals:
+    logging.info(f"Removing {len(ids_to_remove)} duplicate entries in database.")
+    if len(ids_to_remove) > max_removals:
         logging.warning(f"More duplicates detected than threshold. Limiting removal to {max_removals}")
-    for i in range(0, min(max_removals, len(car_id_to_remove)), chunk_size):
-        chunk = car_id_to_remove[i:min(i + chunk_size, len(car_id_to_remove))]
-        supabase.table(table_name).delete().in_("car_id", chunk).execute()
+    for i in range(0, min(max_removals, len(ids_to_remove)), chunk_size):
+        chunk = ids_to_remove[i:min(i + chunk_size, len(ids_to_remove))]
+        supabase.table(table_name).delete().in_("id", chunk).execute()
+
+
+def fetch_one_postcode(code):
+    """Fetch postcode info for a single code from the API. Returns a dict or None on failure."""
+    global _total_429_global
+    session = get_thread_session()
+
+    params = {"postcode": code, "huisnummer": 1}
+
+    _acquire_send_slot()
+    response = session.get(BASE_URL_POST_CODE_API, params=params, timeout=30)
+    if response.status_code == 500:
+        logging.info(f"Response code 500 received for post code: {code}")
+        return None
+    elif response.status_code == 429:
+        _total_429_global = next(_429_counter)
+        logging.warning(f"Response code 429 received for post code: {code}")
+        return None
+
+    payload = orjson.loads(response.content)
+    if not all(k in payload for k in ("latitude", "longitude")):
+        if payload.get('error') == 'Huisnummer not found':
+            params = {
+                "postcode": code,
+                "huisnummer": payload['suggestions'][0]
+            }
+            _acquire_send_slot()
+            response = session.get(BASE_URL_POST_CODE_API, params=params, timeout=30)
+            if response.status_code == 500:
+                logging.info(f"Response code 500 received for post code: {code}")
+                return None
+            elif response.status_code == 429:
+                _total_429_global = next(_429_counter)
+                logging.warning(f"Response code 429 received for post code: {code}")
+                return None
+            payload = orjson.loads(response.content)
+        else:
+            payload = {}
+
+    return {
+        "post_code": code,
+        "huisnummer": payload.get('huisnummer'),
+        "straat": payload.get('straat'),
+        "buurt": payload.get('buurt'),
+        "wijk": payload.get('wijk'),
+        "woonplaats": payload.get('woonplaats'),
+        "gemeente": payload.get('gemeente'),
+        "provincie": payload.get('provincie'),
+        "longitude": payload.get('longitude'),
+        "latitude": payload.get('latitude'),
+    }
 
 
 def fetch_and_insert_postcodes():
     """Fetch missing postcode info from openpostcode.nl API and insert into database."""
     car_adverts_table = "autoscout_car_adverts"
     postcodes_table = "postcode_info_nl"
-    supabase = get_supabase_client()
     global _total_429_global
 
     logging.info("Starting postcode enrichment job...")
 
     # --- Fetch existing postcodes ---
-    response = fetch_all_rows_in_batches(car_adverts_table, "car_id", "car_id, post_code", batch_size=1000)
-    df_full = pd.DataFrame(response).dropna(subset=['post_code'])
-    postcodes_in_car_database = set(df_full['post_code'])
-    response = fetch_all_rows_in_batches(postcodes_table, "post_code", "post_code, latitude", batch_size=1000)
-    df_full = pd.DataFrame(response).dropna(subset=['latitude'])
-    postcodes_in_database = set(df_full['post_code'])
+    postcodes_in_car_database = {
+        row["post_code"]
+        for row in iter_all_rows_in_batches(car_adverts_table, "id", "car_id, post_code", batch_size=1000)
+        if row["post_code"] is not None
+    }
+    postcodes_in_database = {
+        row["post_code"]
+        for row in iter_all_rows_in_batches(postcodes_table, "post_code", "post_code, latitude", batch_size=1000)
+        if row["latitude"] is not None
+    }
     postcodes_not_in_database = postcodes_in_car_database.difference(postcodes_in_database)
     postcodes_to_insert = []
     count_added = 0
     total_to_process = len(postcodes_not_in_database)
     logging.info(f"Found {total_to_process} new postcodes to process.")
 
-    for idx, code in enumerate(postcodes_not_in_database):
-        if code in postcodes_in_database or not code:
-            continue
-        if _total_429_global >= MAX_TOTAL_429:
-            logging.critical("Max 429 limit reached during postcode processing. Stopping.")
-            break
+    codes_to_process = [code for code in postcodes_not_in_database if code]
 
-        params = {"postcode": code, "huisnummer": 1}
-
-        response = requests.get(BASE_URL_POST_CODE_API, params=params)
-        if response.status_code == 500:
-            logging.info(f"Response code 500 received for post code: {code}")
-            continue
-        elif response.status_code == 429:
-            logging.info(f"Response code 429 received for post code: {code}")
-            continue
-        elif all(k in response.json() for k in ("latitude", "longitude")):
-            lat = response.json()['latitude']
-            lon = response.json()['longitude']
-            straat = response.json()['straat']
-            buurt = response.json()['buurt']
-            wijk = response.json()['wijk']
-            woonplaats = response.json()['woonplaats']
-            gemeente = response.json()['gemeente']
-            provincie = response.json()['provincie']
-            huisnummer = response.json()['huisnummer']
-
-        elif response.json()['error'] == 'Huisnummer not found':
-            params = {
-                "postcode": code,
-                "huisnummer": response.json()['suggestions'][0]
-            }
-            response = requests.get(BASE_URL_POST_CODE_API, params=params)
-            if response.status_code == 500:
-                logging.info(f"Response code 500 received for post code: {code}")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(fetch_one_postcode, code): code for code in codes_to_process}
+
+        for future in as_completed(futures):
+            if _total_429_global >= MAX_TOTAL_429:
+                logging.critical("Max 429 limit reached during postcode processing. Stopping.")
+                for pending in futures:
+                    pending.cancel()
+                break
+
+            try:
+                postcode_info = future.result()
+            except Exception as e:
+                logging.error(f"Failed to fetch postcode {futures[future]}: {e}")
                 continue
-            elif response.status_code == 429:
-                logging.info(f"Response code 429 received for post code: {code}")
+            if postcode_info is None:
                 continue
-            else:
-                lat = response.json()['latitude']
-                lon = response.json()['longitude']
-                straat = response.json()['straat']
-                buurt = response.json()['buurt']
-                wijk = response.json()['wijk']
-                woonplaats = response.json()['woonplaats']
-                gemeente = response.json()['gemeente']
-                provincie = response.json()['provincie']
-                huisnummer = response.json()['huisnummer']
-        else:
-            lat = None
-            lon = None
-            straat = None
-            buurt = None
-            wijk = None
-            woonplaats = None
-            gemeente = None
-            provincie = None
-            huisnummer = None
-
-        postcode_info = {
-            "post_code": code,
-            "huisnummer": huisnummer,
-            "straat": straat,
-            "buurt": buurt,
-            "wijk": wijk,
-            "woonplaats": woonplaats,
-            "gemeente": gemeente,
-            "provincie": provincie,
-            "longitude": lon,
-            "latitude": lat,
-        }
-        postcodes_to_insert.append(postcode_info)
-        postcodes_in_database.add(code)
-        time.sleep(random.uniform(0.01, 0.05))
-        if len(postcodes_to_insert) >= BATCH_SIZE_POSTCODES:
-            logging.info(f"Inserting {len(postcodes_to_insert)} postcodes to the database...")
-            supabase.table(postcodes_table).upsert(postcodes_to_insert).execute()
-            count_added += len(postcodes_to_insert)
-            postcodes_to_insert = []
+
+            postcodes_to_insert.append(postcode_info)
+            postcodes_in_database.add(postcode_info["post_code"])
+            if len(postcodes_to_insert) >= BATCH_SIZE_POSTCODES:
+                logging.info(f"Inserting {len(postcodes_to_insert)} postcodes to the database...")
+                pg_upsert(postcodes_table, postcodes_to_insert, on_conflict="post_code")
+                count_added += len(postcodes_to_insert)
+                postcodes_to_insert = []
 
     if postcodes_to_insert:
         logging.info(f"Inserting final {len(postcodes_to_insert)} postcodes to the database...")
-        supabase.table(postcodes_table).upsert(postcodes_to_insert).execute()
+        pg_upsert(postcodes_table, postcodes_to_insert, on_conflict="post_code")
         count_added += len(postcodes_to_insert)
 
     logging.info(f"Postcode enrichment completed. Total inserted: {count_added}")
@@ -530,103 +749,183 @@ def split_and_insert_midpoint(ranges_list: list, start: float, end: float):
 # -------------------------
 # PAGE PROCESSING FUNCTION
 # -------------------------
-def process_page(base_url, params, car_ids_in_database, car_ids_in_upsert):
-    """Fetch and parse a single page, return list of car_info dicts."""
+# Precompiled regexes for the hot parse path
+_POWER_RE = re.compile(r"(\d+)\s*kW.*\((\d+)\s*PK\)")
+_RANGE_RE = re.compile(r"\d+(?:\.\d+)?")
+# Listing <article> open tags and their id/data-* attributes, matched on the
+# raw HTML so the tree parser only runs on articles that are actually new
+_ARTICLE_RE = re.compile(r'<article\b[^>]*\bclass="[^"]*cldt-summary-full-item[^"]*"[^>]*>')
+_ATTR_RE = re.compile(r'\b(id|data-[\w-]+)="([^"]*)"')
+# Compiled XPath selectors for the nested spans of a listing article; the
+# data-testid spans (transmission/fuel/power) are collected in one pass
+_DATA_TESTID_SPANS_XP = etree.XPath('.//span[@data-testid]')
+_TITLE_XP = etree.XPath('.//span[contains(@class, "ListItem_title_bold__iQJRq")]')
+_VERSION_XP = etree.XPath('.//span[contains(@class, "ListItem_version__5EWfi")]')
+_ACTIERADIUS_XP = etree.XPath('.//span[@aria-label="actieradius"]')
+
+
+def _element_text(element):
+    """Stripped text of a (usually leaf) element.
+
+    The spans we extract hold a single text node, so .text avoids the
+    descendant walk and string concatenation of text_content(); the fallback
+    only fires when an element unexpectedly has child nodes.
+    """
+    text = element.text
+    if text is not None and len(element) == 0:
+        return text.strip()
+    return element.text_content().strip()
+
+
+def _xpath_text(element, xpath):
+    """Run a compiled XPath on element and return the first hit's stripped text, or None."""
+    found = xpath(element)
+    return _element_text(found[0]) if found else None
+
+
+def _to_float(value, default=None):
+    """Convert an attribute value to float; a branch handles the common
+    missing-attribute case instead of raising through float(None)."""
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+@dataclass(slots=True)
+class CarRow:
+    """One scraped listing. Slots avoid a per-instance __dict__, roughly
+    halving per-row memory versus the old 19-key dict literal; orjson
+    serializes dataclasses natively at flush time."""
+    car_id: str | None
+    make: str | None
+    model: str | None
+    first_registration: str | None
+    fuel_type: str | None
+    mileage: float
+    post_code_raw: str | None
+    post_code: str | None
+    listing_price: float
+    transmission: str | None
+    fuel_text: str | None
+    power_text: str | None
+    power_kw: float | None
+    power_pk: float | None
+    model_text: str | None
+    model_type: str | None
+    range_raw: str | None
+    range_general: float | None
+    range_urban: float | None
+
+
+
+def process_page(base_url, params, car_ids_known, local_ids):
+    """Fetch and parse a single page, return list of car_info dicts.
+
+    car_ids_known is an immutable snapshot of the IDs already in the database;
+    local_ids is the worker-local set of IDs collected so far in this range.
+    """
     html = rate_limited_fetch_page(base_url, params)
     if html is None:
         logging.warning(f"Skipping page due to repeated failures: {params}")
         return []
 
-    soup = BeautifulSoup(html, "html.parser")
-    car_listings = soup.find_all("article", class_="cldt-summary-full-item")
-    if not car_listings:
+    # Pull the listing open tags straight from the raw HTML; the id and all
+    # data-* fields live on the <article> tag, so the tree parser below only
+    # has to run on the body of articles that are actually new.
+    article_tags = list(_ARTICLE_RE.finditer(html))
+    if not article_tags:
         return -1
 
     results = []
-    for car in car_listings:
-        car_id = car.get("id")
-        if car_id not in car_ids_in_upsert and ((car_id not in car_ids_in_database) or PROCESS_ALL):
-            # Mileage
-            try:
-                data_mileage = float(car.get("data-mileage"))
-            except (ValueError, TypeError):
-                data_mileage = -1
-
-            # Listing price
-            try:
-                listing_price = float(car.get("data-price"))
-            except (ValueError, TypeError):
-                listing_price = -1
+    for index, tag in enumerate(article_tags):
+        # Regex-extracted attribute values are raw text; decode entities the
+        # way the tree parser's .get() used to (unescape no-ops without "&")
+        attrs = {name: unescape(value) for name, value in _ATTR_RE.findall(tag.group(0))}
+        car_id = attrs.get("id")
+        if car_id not in local_ids and (PROCESS_ALL or car_id not in car_ids_known):
+            # Mileage and listing price
+            data_mileage = _to_float(attrs.get("data-mileage"), default=-1)
+            listing_price = _to_float(attrs.get("data-price"), default=-1)
 
             # Postcode
-            raw_postcode = car.get("data-listing-zip-code")
-            try:
-                postcode = raw_postcode[0:4] + raw_postcode[-2:].upper()
-                if not is_valid_format(postcode, POSTCODE_PATTERN):
-                    postcode = None
-            except:
-                postcode = None
-
-            # Transmission, fuel, power
-            transmission = car.find("span", {"data-testid": "VehicleDetails-transmission"})
-            fuel = car.find("span", {"data-testid": "VehicleDetails-gas_pump"})
-            power = car.find("span", {"data-testid": "VehicleDetails-speedometer"})
-
-            transmission_text = transmission.get_text(strip=True) if transmission else None
-            fuel_text = fuel.get_text(strip=True) if fuel else None
-            power_text = power.get_text(strip=True) if power else None
+            raw_postcode = attrs.get("data-listing-zip-code")
+            postcode = None
+            if raw_postcode and len(raw_postcode) >= 6:
+                candidate = raw_postcode[0:4] + raw_postcode[-2:].upper()
+                # Branchless NNNNAA check; candidate is always 6 chars here
+                if candidate[:4].isdigit() and candidate[4:].isalpha():
+                    postcode = candidate
+
+            # Only the nested spans need a real parse; restrict it to this
+            # article's slice, bounded at its own close tag so spans in the
+            # page tail (footer, promoted listings) are never attributed to it
+            body_end = html.find("</article>", tag.end())
+            if body_end == -1:
+                body_end = article_tags[index + 1].start() if index + 1 < len(article_tags) else len(html)
+            body = html[tag.end():body_end]
+
+            span_texts = {}
+            model_text = version_text = actieradius_text = None
+            if body and not body.isspace():
+                car = lxml_html.fromstring(body)
+                # Transmission, fuel, power: one subtree walk for all testid spans
+                span_texts = {el.get("data-testid"): _element_text(el)
+                              for el in _DATA_TESTID_SPANS_XP(car)}
+                # Model and version
+                model_text = _xpath_text(car, _TITLE_XP)
+                version_text = _xpath_text(car, _VERSION_XP)
+                # Actieradius / range
+                actieradius_text = _xpath_text(car, _ACTIERADIUS_XP)
+
+            transmission_text = span_texts.get("VehicleDetails-transmission")
+            fuel_text = span_texts.get("VehicleDetails-gas_pump")
+            power_text = span_texts.get("VehicleDetails-speedometer")
 
             kw_value, pk_value = None, None
             if power_text:
-                match = re.search(r"(\d+)\s*kW.*\((\d+)\s*PK\)", power_text)
+                match = _POWER_RE.search(power_text)
                 if match:
                     kw_value = float(match.group(1))
                     pk_value = float(match.group(2))
 
-            # Model and version
-            title_element = car.find("span", class_="ListItem_title_bold__iQJRq")
-            model_text = title_element.get_text(strip=True) if title_element else None
-            version_element = car.find("span", class_="ListItem_version__5EWfi")
-            version_text = version_element.get_text(strip=True) if version_element else None
-
-            # Actieradius / range
-            actieradius_element = car.find("span", attrs={"aria-label": "actieradius"})
-            actieradius_text = actieradius_element.get_text(strip=True) if actieradius_element else None
-            ranges = [float(num) for num in re.findall(r"\d+(?:\.\d+)?", actieradius_text)] if actieradius_text else []
+            ranges = [float(num) for num in _RANGE_RE.findall(actieradius_text)] if actieradius_text else []
             general_range = ranges[0] if len(ranges) > 0 else None
             urban_range = ranges[1] if len(ranges) > 1 else None
 
             # First registration logic
-            first_reg_raw = car.get("data-first-registration", "").strip().lower()
+            first_reg_raw = attrs.get("data-first-registration", "").strip().lower()
             if first_reg_raw == "unknown":
                 first_registration = None
             elif first_reg_raw == "new":
                 first_registration = datetime.now().strftime("%m-%Y")
             else:
-                first_registration = car.get("data-first-registration")
+                first_registration = attrs.get("data-first-registration")
 
             # Assemble final car info
-            car_info = {
-                "car_id": car_id,
-                "make": car.get("data-make"),
-                "model": car.get("data-model"),
-                "first_registration": first_registration,
-                "fuel_type": car.get("data-fuel-type"),
-                "mileage": data_mileage,
-                "post_code_raw": raw_postcode,
-                "post_code": postcode,
-                "listing_price": listing_price,
-                "transmission": transmission_text,
-                "fuel_text": fuel_text,
-                "power_text": power_text,
-                "power_kw": kw_value,
-                "power_pk": pk_value,
-                "model_text": model_text,
-                "model_type": version_text,
-                "range_raw": actieradius_text,
-                "range_general": general_range,
-                "range_urban": urban_range
-            }
+            car_info = CarRow(
+                car_id=car_id,
+                make=attrs.get("data-make"),
+                model=attrs.get("data-model"),
+                first_registration=first_registration,
+                fuel_type=attrs.get("data-fuel-type"),
+                mileage=data_mileage,
+                post_code_raw=raw_postcode,
+                post_code=postcode,
+                listing_price=listing_price,
+                transmission=transmission_text,
+                fuel_text=fuel_text,
+                power_text=power_text,
+                power_kw=kw_value,
+                power_pk=pk_value,
+                model_text=model_text,
+                model_type=version_text,
+                range_raw=actieradius_text,
+                range_general=general_range,
+                range_urban=urban_range
+            )
             results.append(car_info)
 
     return results
@@ -637,35 +936,39 @@ def process_page(base_url, params, car_ids_in_database, car_ids_in_upsert):
 # -------------------------
 
 def scrape_km_range(base_url, params, price_from, price_to, km_from, km_to,
-                    car_ids_in_database, car_ids_in_upsert):
+                    car_ids_known):
     """Scrape all pages for a given (price, km) pair."""
     local_cars = []
     local_ids = set()
     reached_page_limit = False
 
+    # Round the bucket bounds once, not once per page
+    range_params = params.copy()
+    range_params.update({
+        "pricefrom": round(price_from),
+        "priceto": round(price_to),
+        "kmfrom": round(km_from),
+        "kmto": round(km_to),
+    })
+
     for page_index in range(PAGE_LIMIT):
-        page_params = params.copy()
-        page_params.update({
-            "pricefrom": round(price_from),
-            "priceto": round(price_to),
-            "kmfrom": round(km_from),
-            "kmto": round(km_to),
-            "page": page_index + 1
-        })
+        # range_params is private to this call and pages run sequentially,
+        # so bump the page in place instead of copying the dict per page
+        range_params["page"] = page_index + 1
 
-        page_results = process_page(base_url, page_params, car_ids_in_database, car_ids_in_upsert)
+        page_results = process_page(base_url, range_params, car_ids_known, local_ids)
 
         if page_results == -1:
             # Reached end of pages containing cars
             break
         else:
             local_cars.extend(page_results)
-            local_ids.update([car["car_id"] for car in page_results])
+            local_ids.update([car.car_id for car in page_results])
 
         # If we completed the last allowed page, mark that this range hit the page limit
         if page_index + 1 == PAGE_LIMIT:
-            logging.info(f"Reached page limit for price {page_params['pricefrom']}-{page_params['priceto']} "
-                         f"and mileage {page_params['kmfrom']}-{page_params['kmto']}")
+            logging.info(f"Reached page limit for price {range_params['pricefrom']}-{range_params['priceto']} "
+                         f"and mileage {range_params['kmfrom']}-{range_params['kmto']}")
             reached_page_limit = True
 
     return local_cars, local_ids, reached_page_limit, price_from, price_to, km_from, km_to
@@ -679,27 +982,14 @@ def scrape_cars(table_name):
     AUTO_ADJUST_ON_LIMIT = ranges_settings.get("auto_adjust_on_limit", True)
 
     if price_list is None:
-        price_ranges: np.ndarray = np.array(
-            [0, 500, 650, 700, 750, 850, 1000, 1100, 1250, 1500, 1750, 2000, 2250, 2500, 2750, 3000, 3250, 3500, 4000, 4500,
-             5000, 5500, 6000, 6500, 7000, 7500, 8000, 8500, 9000, 9500, 10000, 10500, 11000, 11500, 12000, 12500, 13000,
-             13500, 14000, 14500, 15000, 15500, 16000, 16500, 17000, 17500, 18000, 18500, 19000, 19500, 19750, 20000, 20500,
-             21000, 21500, 22000, 22500, 23000, 23500, 24000, 24500, 25000, 26000, 27000, 28000, 28500, 29000, 30000, 31000, 32000,
-             33000, 34000, 34500, 35000, 35500, 36000, 36500, 37000, 37500, 38000, 39000, 39500, 40000, 41000, 42000, 43000, 43500, 44000, 44500, 45000,
-             46000, 47000, 48000, 49000, 50000, 51000, 52000, 53000, 54000, 55000, 56000, 57000, 58000, 59000, 60000, 61000,
-             62000, 64000, 66000, 68000, 70000, 75000, 80000, 85000, 90000, 95000, 100000, 125000, 150000, 1e9])
-        price_list = price_ranges.tolist()
-    else:
-        price_ranges = np.array(price_list)
-
+        price_list = list(DEFAULT_PRICE_RANGES)
     if km_list is None:
-        km_ranges: np.ndarray = np.array(
-            [0, 1, 2, 5, 7, 8, 10, 11, 12, 15, 20, 50, 100, 200, 500, 1000, 2000, 3000, 5000, 10000, 15000, 20000, 25000,
-             30000, 35000, 40000, 45000, 50000, 55000, 60000, 70000, 80000, 85000, 90000, 95000, 100000, 110000, 120000, 130000, 140000,
-             145000, 150000, 155000, 160000, 170000, 180000, 190000, 200000, 210000, 220000, 230000, 240000, 260000, 280000,
-             300000, 350000, 400000, 1e9])
-        km_list = km_ranges.tolist()
-    else:
-        km_ranges = np.array(km_list)
+        km_list = list(DEFAULT_KM_RANGES)
+
+    # Aliases: the split logic mutates km_list in place and the loops pick the
+    # change up automatically, no numpy rebuild needed
+    price_ranges = price_list
+    km_ranges = km_list
 
     ranges_lock = threading.Lock()
     # Collect requested splits during the run; persist only at the end to avoid file write conflicts
@@ -717,8 +1007,15 @@ def scrape_cars(table_name):
         "ustate": "N,U"
     }
 
-    car_rows = fetch_all_rows_in_batches(table_name, "car_id", "car_id", batch_size=50000)
-    car_ids_in_database = {row["car_id"] for row in car_rows if "car_id" in row}
+    # Highest PK seen so far; periodic refreshes only fetch rows above it
+    pk_watermark = [None]
+    if PROCESS_ALL:
+        # Everything gets re-scraped anyway; skip the full ID prefetch and let
+        # upsert(ignore_duplicates) handle idempotency server-side
+        car_ids_in_database = set()
+    else:
+        car_ids_in_database = build_known_ids(
+            iter_new_car_ids(table_name, None, pk_watermark))
     car_ids_in_upsert = set()
     cars_to_insert = []
     count_added = 0
@@ -728,35 +1025,71 @@ def scrape_cars(table_name):
     # --- Lock for thread-safe modifications ---
     ids_lock = threading.Lock()
 
+    # One long-lived pool for the whole run: avoids spinning up and joining
+    # MAX_WORKERS threads for every price band and keeps the per-thread
+    # sessions (and their keep-alive connections) warm across bands.
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS) if ENABLE_MULTITHREADING else None
+
+    # Single-threaded writer pool: batch upserts and ID refreshes run behind
+    # the scrape so their DB round-trips overlap page fetching instead of
+    # stalling all workers between price bands.
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    pending_db_futures = []
+    refresh_future = None
+
     # --- Main nested loop (threading at KM level) ---
     for price_index in range(len(price_ranges) - 1):
         price_from = int(price_ranges[price_index])
         price_to = int(price_ranges[price_index + 1])
         logging.info(f"Evaluating price range {price_from}-{price_to} "
-                     f"({round((price_index + 1) / len(price_ranges) * 100, 2)}%)")
-
-        if price_index % DB_REFRESH_RATE == 0:
-            car_rows = fetch_all_rows_in_batches(table_name, "car_id", "car_id", batch_size=50000)
-            car_ids_in_database = {row["car_id"] for row in car_rows if "car_id" in row}
+                     f"({100 * (price_index + 1) / len(price_ranges):.2f}%)")
+
+        if price_index % DB_REFRESH_RATE == 0 and price_index > 0 and refresh_future is None \
+                and not PROCESS_ALL:
+            # Incremental refresh in the background: this run is the only
+            # writer, so the local set only drifts by rows added since the
+            # watermark — fetch just those instead of the whole table.
+            refresh_future = db_executor.submit(
+                lambda start=pk_watermark[0]: set(
+                    iter_new_car_ids(table_name, start, pk_watermark)))
+        if refresh_future is not None and refresh_future.done():
+            try:
+                new_ids = refresh_future.result()
+                with ids_lock:
+                    if isinstance(car_ids_in_database, (set, frozenset)):
+                        car_ids_in_database |= new_ids
+                    else:
+                        for car_id in new_ids:
+                            car_ids_in_database.add(car_id)
+            except Exception as e:
+                logging.error(f"Background car_id refresh failed: {e}")
+            refresh_future = None
+
+        # Immutable snapshot for this price band: workers probe this instead of
+        # the shared sets that the merge step below keeps mutating.
+        car_ids_known = snapshot_known_ids(car_ids_in_database, car_ids_in_upsert)
 
         if ENABLE_MULTITHREADING:
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = [
-                    executor.submit(
-                        scrape_km_range, base_url, params, price_from, price_to,
-                        km_ranges[i], km_ranges[i + 1],
-                        car_ids_in_database, car_ids_in_upsert
-                    )
-                    for i in range(len(km_ranges) - 1)
-                ]
-
-                for future in as_completed(futures):
+            pending = {
+                executor.submit(
+                    scrape_km_range, base_url, params, price_from, price_to,
+                    km_ranges[i], km_ranges[i + 1],
+                    car_ids_known
+                )
+                for i in range(len(km_ranges) - 1)
+            }
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
                     try:
                         km_cars, _, reached_limit, pf, pt, kf, kt = future.result()
                         with ids_lock:
                             for car in km_cars:
-                                car_id = car["car_id"]
-                                if car_id not in car_ids_in_database:
+                                car_id = car.car_id
+                                if PROCESS_ALL:
+                                    cars_to_insert.append(car)
+                                elif car_id not in car_ids_in_database:
                                     cars_to_insert.append(car)
                                     car_ids_in_database.add(car_id)
                                     car_ids_in_upsert.add(car_id)
@@ -766,12 +1099,29 @@ def scrape_cars(table_name):
                             try:
                                 with ranges_lock:
                                     key = (float(kf), float(kt))
-                                    if key not in splits_to_apply:
+                                    km_mid = (float(kf) + float(kt)) / 2.0
+                                    # Only split when the midpoint rounds to a new
+                                    # query bound; otherwise a half would repeat the
+                                    # parent's exact query, re-saturate and recurse
+                                    if key not in splits_to_apply \
+                                            and round(kf) < round(km_mid) < round(kt):
                                         changed = split_and_insert_midpoint(km_list, kf, kt)
                                         if changed:
-                                            km_ranges = np.array(km_list)
                                             splits_to_apply.add(key)
-                                            logging.info(f"Auto-split km range {kf}-{kt} applied in-memory (queued save).")
+                                            # Rescan both halves in this run so the
+                                            # listings past the page limit aren't
+                                            # deferred to the next run. Duplicate hits
+                                            # from the already-scraped pages fall out
+                                            # via the known-ID checks above.
+                                            pending.add(executor.submit(
+                                                scrape_km_range, base_url, params,
+                                                price_from, price_to, kf, km_mid,
+                                                car_ids_known))
+                                            pending.add(executor.submit(
+                                                scrape_km_range, base_url, params,
+                                                price_from, price_to, km_mid, kt,
+                                                car_ids_known))
+                                            logging.info(f"Auto-split km range {kf}-{kt} applied in-memory (queued save), rescanning halves.")
                             except Exception as e:
                                 logging.error(f"Failed to auto-adjust ranges: {e}")
                     except Exception as e:
@@ -779,22 +1129,30 @@ def scrape_cars(table_name):
 
             with ids_lock:
                 if len(cars_to_insert) >= BATCH_SIZE:
-                    insert_batch_to_db(table_name, cars_to_insert)
+                    pending_db_futures.append(
+                        db_executor.submit(insert_batch_to_db, table_name, cars_to_insert.copy()))
                     count_added += len(cars_to_insert)
                     cars_to_insert.clear()
                     car_ids_in_upsert.clear()
                     # logging.info(f"Inserted {count_added} total cars")
         else:
             # Sequential fallback
-            for i in range(len(km_ranges) - 1):
+            work = deque(
+                (km_ranges[i], km_ranges[i + 1])
+                for i in range(len(km_ranges) - 1)
+            )
+            while work:
+                km_from, km_to = work.popleft()
                 km_cars, _, reached_limit, pf, pt, kf, kt = scrape_km_range(
                     base_url, params, price_from, price_to,
-                    km_ranges[i], km_ranges[i + 1],
-                    car_ids_in_database, car_ids_in_upsert
+                    km_from, km_to,
+                    car_ids_known
                 )
                 for car in km_cars:
-                    car_id = car["car_id"]
-                    if car_id not in car_ids_in_database:
+                    car_id = car.car_id
+                    if PROCESS_ALL:
+                        cars_to_insert.append(car)
+                    elif car_id not in car_ids_in_database:
                         cars_to_insert.append(car)
                         car_ids_in_database.add(car_id)
                         car_ids_in_upsert.add(car_id)
@@ -803,28 +1161,50 @@ def scrape_cars(table_name):
                     try:
                         with ranges_lock:
                             key = (float(kf), float(kt))
-                            if key not in splits_to_apply:
+                            km_mid = (float(kf) + float(kt)) / 2.0
+                            # Only split when the midpoint rounds to a new query
+                            # bound; otherwise a half would repeat the parent's
+                            # exact query, re-saturate and recurse
+                            if key not in splits_to_apply \
+                                    and round(kf) < round(km_mid) < round(kt):
                                 changed = split_and_insert_midpoint(km_list, kf, kt)
                                 if changed:
-                                    km_ranges = np.array(km_list)
                                     splits_to_apply.add(key)
-                                    logging.info(f"Auto-split km range {kf}-{kt} applied in-memory (queued save).")
+                                    # Rescan both halves in this run; duplicates
+                                    # fall out via the known-ID checks above.
+                                    work.append((kf, km_mid))
+                                    work.append((km_mid, kt))
+                                    logging.info(f"Auto-split km range {kf}-{kt} applied in-memory (queued save), rescanning halves.")
                     except Exception as e:
                         logging.error(f"Failed to auto-adjust ranges: {e}")
 
             with ids_lock:
                 if len(cars_to_insert) >= BATCH_SIZE:
-                    insert_batch_to_db(table_name, cars_to_insert)
+                    pending_db_futures.append(
+                        db_executor.submit(insert_batch_to_db, table_name, cars_to_insert.copy()))
                     count_added += len(cars_to_insert)
                     cars_to_insert.clear()
                     car_ids_in_upsert.clear()
 
+    if executor is not None:
+        executor.shutdown(wait=True)
+
     # Final insert
     with ids_lock:
         if cars_to_insert:
-            insert_batch_to_db(table_name, cars_to_insert)
+            pending_db_futures.append(
+                db_executor.submit(insert_batch_to_db, table_name, cars_to_insert.copy()))
+            logging.info(f"Final batch queued ({len(cars_to_insert)} cars)")
             count_added += len(cars_to_insert)
-            logging.info(f"Final batch inserted ({len(cars_to_insert)} cars)")
+            cars_to_insert.clear()
+
+    # Drain the writer pool before reporting totals
+    for db_future in pending_db_futures:
+        try:
+            db_future.result()
+        except Exception as e:
+            logging.error(f"Background batch insert failed: {e}")
+    db_executor.shutdown(wait=True)
 
     logging.info(f"Total cars added: {count_added}")
     # Persist any queued range splits once at the end to avoid file write conflicts
@@ -860,19 +1240,23 @@ def main():
 
 
 if __name__ == '__main__':
-    pr = cProfile.Profile()
-    pr.enable()
+    # Profiling is opt-in: the tracer adds noticeable overhead to the parse path
+    pr = None
+    if os.getenv("PROFILE"):
+        pr = cProfile.Profile()
+        pr.enable()
     try:
-        time.sleep(np.random.uniform(0, 100))
+        time.sleep(random.uniform(0, 100))
         main()
     except Exception as e:
         logging.exception("Script crashed")
         raise
     finally:
-        pr.disable()
-        s = io.StringIO()
-        ps = pstats.Stats(pr, stream=s)
-        ps.strip_dirs()
-        ps.sort_stats("cumtime")
-        ps.print_stats(20)
-        logging.info("Profiling results:\n%s", s.getvalue())
+        if pr is not None:
+            pr.disable()
+            s = io.StringIO()
+            ps = pstats.Stats(pr, stream=s)
+            ps.strip_dirs()
+            ps.sort_stats("cumtime")
+            ps.print_stats(20)
+            logging.info("Profiling results:\n%s", s.getvalue())